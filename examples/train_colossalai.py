@@ -11,6 +11,19 @@ from tunelite.trainer.colossalai_trainer import ColossalaiTrainer, TrainerArgs
 import torch
 from torch.utils.data import DataLoader
 
+def tokenize_fn(batch, tokenizer, max_length=1024, bos=True, eos=True):
+    # HFLikeTokenizer.__call__ ignores max_length/truncation and pads to the
+    # batch max, so encode and truncate each document itself and store the
+    # ids unpadded
+    input_ids = []
+    for text in batch['text']:
+        ids = tokenizer.tokenizer.encode(text, bos=bos, eos=eos)[:max_length]
+        if eos and len(ids) > 0 and ids[-1] != tokenizer.eos_id:
+            ids[-1] = tokenizer.eos_id
+        input_ids.append(ids)
+    return {'input_ids': input_ids}
+
+
 def collate_fn(batch, tokenizer, max_length=1024, bos=True, eos=True):
     text = [e['text'] for e in batch]
     tknz_batch = tokenizer(
@@ -23,18 +36,94 @@ def collate_fn(batch, tokenizer, max_length=1024, bos=True, eos=True):
         eos=eos
     )
     tknz_batch['input_ids'] = tknz_batch['input_ids'][:, :max_length-1]
-    return {
-        'input_ids': tknz_batch['input_ids'].long()
-    }, tknz_batch['input_ids'].long()
-    
+    input_ids = tknz_batch['input_ids'].to(torch.int32)
+    return {'input_ids': input_ids}, input_ids
+
+
+def pack_fn(batch, max_length=1024):
+    # greedily concatenate EOS-terminated documents into fixed-length rows;
+    # running this as a dataset.map step keeps every batch the same shape, so
+    # the pipeline schedule can slice it into micro-batches. The model
+    # rebuilds the block-diagonal attention boundaries per micro-batch from
+    # the EOS positions (see ModelArgs.packed).
+    rows = []
+    row = []
+    for ids in batch['input_ids']:
+        ids = ids[:max_length]
+        if len(ids) == 0:
+            continue
+        if len(row) + len(ids) > max_length:
+            row.extend([0] * (max_length - len(row)))
+            rows.append(row)
+            row = []
+        row.extend(ids)
+    if len(row) > 0:
+        row.extend([0] * (max_length - len(row)))
+        rows.append(row)
+    return {'input_ids': rows}
+
+
+def packed_collate_fn(batch):
+    input_ids = torch.stack([e['input_ids'] for e in batch]).to(torch.int32)
+    return {'input_ids': input_ids}, input_ids
+
+
+class LengthBucketSampler:
+    """Yields batches of indices whose tokenized lengths are similar, so
+    padding to the batch max wastes far fewer tokens than padding to the
+    global max_length. A lighter alternative to `PackedCollator` that keeps
+    the padded LLaMA forward untouched.
+    """
+
+    def __init__(self, lengths, batch_size=32, bucket_size=3200, shuffle=True):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return sum(min(self.bucket_size, len(self.lengths) - start) // self.batch_size
+                   for start in range(0, len(self.lengths), self.bucket_size))
+
+    def __iter__(self):
+        if self.shuffle:
+            order = torch.randperm(len(self.lengths)).tolist()
+        else:
+            order = list(range(len(self.lengths)))
+        for start in range(0, len(order), self.bucket_size):
+            bucket = sorted(order[start:start + self.bucket_size],
+                            key=self.lengths.__getitem__)
+            # drop the trailing partial batch: the pipeline schedule needs
+            # every batch to split evenly into micro-batches, and a
+            # batch_sampler bypasses the DataLoader's drop_last flag
+            batches = [bucket[i:i + self.batch_size]
+                       for i in range(0, len(bucket) - self.batch_size + 1,
+                                      self.batch_size)]
+            if self.shuffle:
+                batches = [batches[i] for i in torch.randperm(len(batches)).tolist()]
+            yield from batches
+
+
+def bucketed_collate_fn(batch):
+    # rows are stored unpadded, so left-pad to the batch max only, the same
+    # way the tokenizer pads raw text
+    max_len = max(max(len(e['input_ids']) for e in batch), 1)
+    input_ids = torch.zeros(len(batch), max_len, dtype=torch.int32)
+    for i, e in enumerate(batch):
+        ids = e['input_ids']
+        input_ids[i, max_len - len(ids):] = ids
+    return {'input_ids': input_ids}, input_ids
+
 
 def main():
     tokenizer = HFLikeTokenizer(
         tokenizer=Tokenizer(model_path='/mnt/petrelfs/zhangshuo/projects/OptiLLM/colossalai/llama/tokenizer.model'))
     def compute_metrics(batch, generated_batch, epoch, step):
         print("\n")
-        print("\n".join([tokenizer.decode(token.tolist()) for token in generated_batch[0]["input_ids"]][:1]))
+        # only the first sample gets printed, so only decode that one
+        print(tokenizer.decode(generated_batch[0]["input_ids"][0].tolist()))
         print("\n")
+    use_packing = True
     model_args = ModelArgs()
     model_args.pp_size = 8
     model_args.micro_batch_size = 32
@@ -43,26 +132,65 @@ def main():
     model_args.dense = "fused"
     model_args.attention = "flash"
     model_args.rotary_emb = "fused"
+    model_args.packed = use_packing
     
     trainer_args = TrainerArgs()
     trainer_args.eval_max_length = 128
     trainer_args.eval_per_steps = 10
     trainer_args.eval_per_epoches = 1
     trainer_args.learning_rate = 2e-5
+    trainer_args.grad_accum_steps = 4
     
     model = get_13B_llama(model_args)
     state_dict = load_state_dict(model_args=model_args, s3_folder="hdd:s3://opennlplab_hdd/models/llama/llama-13b-hf")
     model.load_state_dict(state_dict)
     dataset = load_dataset("NeelNanda/pile-10k")["train"]
-    train_dataloader = DataLoader(
-        dataset,
-        batch_size=32,
-        collate_fn=lambda x: collate_fn(x, tokenizer, 1024),
+    dataset = dataset.map(
+        lambda batch: tokenize_fn(batch, tokenizer, 1024),
+        batched=True,
+        num_proc=8,
+        remove_columns=["text"],
     )
+    if use_packing:
+        dataset = dataset.map(
+            lambda batch: pack_fn(batch, 1024),
+            batched=True,
+            num_proc=8,
+            remove_columns=["input_ids"],
+        )
+        dataset.set_format("torch", columns=["input_ids"])
+        train_dataloader = DataLoader(
+            dataset,
+            batch_size=32,
+            collate_fn=packed_collate_fn,
+            drop_last=True,
+            pin_memory=True,
+            num_workers=4,
+            persistent_workers=True,
+            prefetch_factor=4,
+        )
+    else:
+        # bucketing by length cuts most of the padding without touching the
+        # attention path; keep it as the fallback to sequence packing
+        lengths = [len(ids) for ids in dataset["input_ids"]]
+        dataset.set_format("torch", columns=["input_ids"])
+        train_dataloader = DataLoader(
+            dataset,
+            batch_sampler=LengthBucketSampler(lengths, batch_size=32),
+            collate_fn=bucketed_collate_fn,
+            pin_memory=True,
+            num_workers=4,
+            persistent_workers=True,
+            prefetch_factor=4,
+        )
     eval_dataloader = DataLoader(
         [{"text": "When I see the python package TuneLite, I fell"} for _ in range(32)],
         batch_size=32,
         collate_fn=lambda x: collate_fn(x, tokenizer, 1024, eos=False),
+        pin_memory=True,
+        num_workers=4,
+        persistent_workers=True,
+        prefetch_factor=4,
     )
     trainer = ColossalaiTrainer(model=model,
                                 train_dataloader=train_dataloader,
@@ -77,9 +205,13 @@ def main():
 if __name__ == "__main__":
     try:
         main()
-    except:
+    # KeyboardInterrupt/SystemExit propagate untouched so torchrun can tear
+    # the job down promptly
+    except Exception:
         if os.environ.get("RANK") == "0" or os.environ.get("RANK") == f"{int(os.environ.get('WORLD_SIZE'))-1}":
             import rich
             console = rich.console.Console()
-            console.print_exception(show_locals=True)
-        print(f"\nExceptions at Rank: {os.environ.get('RANK')}\n")
\ No newline at end of file
+            # show_locals would render whole model tensors and delay restart
+            console.print_exception(show_locals=False, max_frames=10, width=200)
+        print(f"\nExceptions at Rank: {os.environ.get('RANK')}\n")
+        raise
\ No newline at end of file
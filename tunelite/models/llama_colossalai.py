@@ -48,11 +48,13 @@ except ModuleNotFoundError:
 try:
     from flash_attn.layers.rotary import RotaryEmbedding
     from flash_attn.flash_attention import FlashAttention
+    from flash_attn.flash_attn_interface import flash_attn_unpadded_qkvpacked_func
     from flash_attn.ops.fused_dense import FusedDense as FlashAttnFusedDense
 except ModuleNotFoundError:
     FlashAttention = None
     RotaryEmbedding = None
     FlashAttnFusedDense = None
+    flash_attn_unpadded_qkvpacked_func = None
 
 try:
     from xformers.ops import memory_efficient_attention
@@ -86,6 +88,27 @@ class ModelArgs:
     dropout: float = 0.1
     fp16: bool = True
     backend: str = "nccl"
+    packed: bool = False  # train on EOS-packed rows with block-diagonal attention
+    eos_token_id: int = 2
+
+
+def _packed_cu_seqlens(input_ids: torch.Tensor, eos_token_id: int):
+    """Rebuild the var-len attention boundaries of EOS-packed rows.
+
+    The pipeline schedule slices each batch into micro-batches along dim 0,
+    so the boundaries have to be derived from the micro-batch the kernel
+    actually sees. Every EOS ends a sequence, and every row end is a forced
+    boundary so a trailing padding run forms its own block.
+    """
+    batch_size, seq_len = input_ids.shape
+    flat = input_ids.reshape(-1)
+    ends = flat == eos_token_id
+    ends[seq_len - 1::seq_len] = True
+    boundaries = torch.nonzero(ends).flatten() + 1
+    cu_seqlens = torch.cat(
+        [boundaries.new_zeros(1), boundaries]).to(torch.int32)
+    max_seqlen = int((cu_seqlens[1:] - cu_seqlens[:-1]).max())
+    return cu_seqlens, max_seqlen
 
 
 class RMSNorm(nn.Module):
@@ -150,8 +173,31 @@ class TransformerBlock(nn.Module):
         self.model_args = model_args
         self.attention = nn.ModuleDict()
         self.mlp = nn.ModuleDict()
+        self.cache_k = None
+        self.cache_v = None
+        self._cache_row = 0
+        self._cache_pos = -1
         self._construct()
 
+    def init_kv_cache(self,
+                      max_batch_size: int,
+                      max_seq_len: int,
+                      device: torch.device,
+                      dtype: torch.dtype):
+        head_dim = self.model_args.hidden_size // self.model_args.num_attention_heads
+        self.cache_k = torch.zeros(
+            (max_batch_size, max_seq_len, self.model_args.num_attention_heads, head_dim),
+            device=device, dtype=dtype)
+        self.cache_v = torch.zeros_like(self.cache_k)
+        self._cache_row = 0
+        self._cache_pos = -1
+
+    def clear_kv_cache(self):
+        self.cache_k = None
+        self.cache_v = None
+        self._cache_row = 0
+        self._cache_pos = -1
+
     def _construct(self):
         if self.model_args.dense == "raw":
             self.attention["wqkv"] = col_nn.Linear(self.model_args.hidden_size,
@@ -237,10 +283,28 @@ class TransformerBlock(nn.Module):
             assert FlashAttention is not None, \
                 "Detected flash_attn is not installed. See https://github.com/HazyResearch/flash-attention"
             def attention(**kwargs):
-                output, _ = FlashAttention()(
-                    kwargs["qkv"], causal=kwargs.get("causal", True))
-                output = rearrange(
-                    output, "b n h d -> b n (h d)", n=kwargs.get("seq_len"))
+                if kwargs.get("cu_seqlens", None) is not None:
+                    # packed sequences: run the unpadded kernel over the
+                    # flattened tokens so the mask is block-diagonal and
+                    # attention never crosses document boundaries
+                    qkv = rearrange(
+                        kwargs["qkv"], "b n three h d -> (b n) three h d")
+                    # no in-kernel dropout: the padded branch's
+                    # FlashAttention() runs with its 0.0 default and both
+                    # share the post-attention F.dropout below
+                    output = flash_attn_unpadded_qkvpacked_func(
+                        qkv,
+                        kwargs["cu_seqlens"],
+                        kwargs["max_seqlen"],
+                        dropout_p=0.0,
+                        causal=kwargs.get("causal", True))
+                    output = rearrange(
+                        output, "(b n) h d -> b n (h d)", n=kwargs.get("seq_len"))
+                else:
+                    output, _ = FlashAttention()(
+                        kwargs["qkv"], causal=kwargs.get("causal", True))
+                    output = rearrange(
+                        output, "b n h d -> b n (h d)", n=kwargs.get("seq_len"))
                 output = F.dropout(
                     output, p=self.model_args.dropout, training=self.training)
                 return output
@@ -302,8 +366,11 @@ class TransformerBlock(nn.Module):
                 hidden_states: Optional[torch.Tensor],
                 past_key_value: Optional[torch.Tensor] = None,
                 causal: bool = True,
-                rpoe: Callable = None):
-        
+                rpoe: Callable = None,
+                cu_seqlens: Optional[torch.Tensor] = None,
+                max_seqlen: int = 0,
+                cache_pos: Optional[int] = None):
+
         assert hidden_states.ndim == 3, f"hidden_states.shape must be (B, N, H), but got {hidden_states.shape}"
         batch_size, seq_len, hidden_size = hidden_states.shape
         head_dim = self.model_args.hidden_size // self.model_args.num_attention_heads
@@ -317,6 +384,59 @@ class TransformerBlock(nn.Module):
             qkv, split_size_or_sections=1, dim=2)
         query, key, value = query.squeeze(
             2), key.squeeze(2), value.squeeze(2)
+        if cache_pos is not None and self.cache_k is not None:
+            # incremental decoding: only the new positions run through the
+            # projections, attention reads the cached K/V of earlier steps
+            start_pos = int(cache_pos)
+            # the schedule feeds the global batch micro-batch by micro-batch,
+            # so advance a row cursor within one decode step and reset it
+            # whenever a new position starts arriving
+            if start_pos != self._cache_pos:
+                self._cache_row = 0
+                self._cache_pos = start_pos
+            row = self._cache_row
+            self._cache_row = row + batch_size
+            query, key = rpoe(query=query, key=key,
+                              start_pos=start_pos, seq_len=seq_len)
+            self.cache_k[row:row + batch_size, start_pos:start_pos + seq_len] = key
+            self.cache_v[row:row + batch_size, start_pos:start_pos + seq_len] = value
+            key = self.cache_k[row:row + batch_size, :start_pos + seq_len]
+            value = self.cache_v[row:row + batch_size, :start_pos + seq_len]
+            if start_pos == 0:
+                # prefill: plain causal attention over the whole prompt
+                qkv = torch.stack([query, key, value], dim=2)
+                attention_output = self.attention_fn(
+                    qkv=qkv,
+                    sm_scale=1 / math.sqrt(head_dim),
+                    batch_size=batch_size,
+                    seq_len=seq_len,
+                    dropout_p=self.model_args.dropout,
+                    causal=causal)
+            else:
+                # decode: attend only the new queries over the filled prefix,
+                # O(T*d) per token instead of rebuilding the T x T square
+                # with zero-padded queries
+                q = query.transpose(1, 2)
+                k = key.permute(0, 2, 3, 1)
+                v = value.transpose(1, 2)
+                attention_score = torch.matmul(q, k) / math.sqrt(head_dim)
+                if causal and seq_len > 1:
+                    mask = torch.triu(attention_score.new_full(
+                        (seq_len, seq_len), float("-inf")), diagonal=1)
+                    attention_score[..., start_pos:] = attention_score[..., start_pos:] + mask
+                attention_score = F.softmax(
+                    attention_score, dim=-1).type_as(v)
+                attention_output = torch.matmul(attention_score, v)
+                attention_output = attention_output.transpose(1, 2).reshape(
+                    batch_size, seq_len,
+                    head_dim * self.model_args.num_attention_heads)
+                attention_output = F.dropout(
+                    attention_output, p=self.model_args.dropout, training=self.training)
+            hidden_states = hidden_states + self.attention["wo"](attention_output)
+            _hidden_states = self.mlp["norm"](hidden_states)
+            hidden_states = hidden_states + self.mlp["dropout"](
+                self.mlp["w2"](F.silu(self.mlp["w1"](_hidden_states)) * self.mlp["w3"](_hidden_states)))
+            return hidden_states
         if past_key_value is None:
             start_pos = 0
         else:
@@ -339,7 +459,9 @@ class TransformerBlock(nn.Module):
                               batch_size=batch_size,
                               seq_len=seq_len,
                               dropout_p=self.model_args.dropout,
-                              causal=causal)
+                              causal=causal,
+                              cu_seqlens=cu_seqlens,
+                              max_seqlen=max_seqlen)
         )
         if past_key_value is not None:
             hidden_states = hidden_states[:, start_pos:, ...]
@@ -397,10 +519,21 @@ class Transformer(nn.Module):
                 hidden_states: Optional[torch.Tensor] = None,
                 input_ids: Optional[torch.Tensor] = None,
                 past_key_value: Optional[torch.Tensor] = None,
+                cu_seqlens: Optional[torch.Tensor] = None,
+                max_seqlen: int = 0,
+                cache_pos: Optional[torch.Tensor] = None,
                 **kwargs):
         if self.is_start:
             assert input_ids is not None, "`input_ids` is not allowed to be None in the first pipeline node. "
             hidden_states = self.token_embedding(input_ids)
+        if (cu_seqlens is None and self.model_args.packed and self.training
+                and input_ids is not None):
+            cu_seqlens, max_seqlen = _packed_cu_seqlens(
+                input_ids, self.model_args.eos_token_id)
+        if cache_pos is not None and torch.is_tensor(cache_pos):
+            # the trainer ships one entry per row so the schedule can slice
+            # it; every row carries the same position
+            cache_pos = int(cache_pos[0])
         if past_key_value is not None:
             if 0 in past_key_value[0].shape:
                 # past_key_value shape is (B, layers, N, 2, H, D)
@@ -413,16 +546,22 @@ class Transformer(nn.Module):
         for i in range(len(self.blocks)):
             if self.model_args.checkpoint and self.training:
                 hidden_states = checkpoint(self.blocks[i], True,
-                                           hidden_states, 
-                                           past_key_value[:, i, ...] if past_key_value is not None else past_key_value, 
-                                           True, 
-                                           self.rope)
+                                           hidden_states,
+                                           past_key_value[:, i, ...] if past_key_value is not None else past_key_value,
+                                           True,
+                                           self.rope,
+                                           cu_seqlens,
+                                           max_seqlen,
+                                           cache_pos)
             else:
                 hidden_states = self.blocks[i](
-                    hidden_states, 
-                    past_key_value[:, i, ...] if past_key_value is not None else past_key_value, 
-                    True, 
-                    self.rope)
+                    hidden_states,
+                    past_key_value[:, i, ...] if past_key_value is not None else past_key_value,
+                    True,
+                    self.rope,
+                    cu_seqlens,
+                    max_seqlen,
+                    cache_pos)
             if past_key_value is not None:
                 past_key_value[:, i, ...] = hidden_states[1]
                 hidden_states = hidden_states[0]
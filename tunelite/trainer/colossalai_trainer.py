@@ -1,8 +1,8 @@
 import os
 import tqdm
 import torch
-from itertools import cycle
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple, Dict
 from dataclasses import dataclass, field
 
@@ -16,7 +16,26 @@ try:
 except ModuleNotFoundError:
     raise ModuleNotFoundError(
         "Detected Colossal-AI is not installed. See https://github.com/hpcaitech/ColossalAI")
+
+try:
+    from colossalai.nn.optimizer import FusedSGD
+except (ModuleNotFoundError, ImportError):
+    FusedSGD = None
         
+class _Repeat:
+    """Endlessly yields the same item, without the list + iterator that
+    ``cycle([item])`` allocates on every schedule call."""
+
+    def __init__(self, item=None):
+        self.item = item
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.item
+
+
 @dataclass
 class TrainerArgs:
     learning_rate: float = field(
@@ -27,6 +46,11 @@ class TrainerArgs:
         metadata={"help": "Total number of training epochs to perform. "
                   "If it is set to -1, the training will run forever."
                   "If it is set to 0, the training will not run."})
+    grad_accum_steps: int = field(
+        default=1,
+        metadata={"help": "The number of steps to accumulate gradients before "
+                  "the optimizer steps. If it is set to 1, the optimizer "
+                  "steps after every training step."})
     eval_per_steps: int = field(
         default=10,
         metadata={"help": "The number of steps to perform evaluation. " 
@@ -64,37 +88,101 @@ class ColossalaiTrainer:
         self.tokenizer = tokenizer
         self.compute_metrics = compute_metrics
         self.trainer_args = trainer_args
-        self.optimizer = torch.optim.SGD(self.model.parameters(), lr=trainer_args.learning_rate)
+        # the fused optimizer launches one kernel per param group instead of
+        # one per tensor; fall back to the eager SGD when apex is missing
+        optimizer_cls = FusedSGD if FusedSGD is not None else torch.optim.SGD
+        self.optimizer = optimizer_cls(self.model.parameters(), lr=trainer_args.learning_rate)
+        # each accumulated window contributes 1/K of the loss so the summed
+        # gradients average over the window instead of scaling with K
+        self.grad_accum_steps = max(trainer_args.grad_accum_steps, 1)
         self.engine, self.train_dataloader, self.eval_dataloader, _ = colossalai.initialize(
             model=self.model,
             train_dataloader=train_dataloader,
             test_dataloader=eval_dataloader,
             optimizer=self.optimizer,
-            criterion=GPTLMLoss()
+            criterion=GPTLMLoss(eos_token_id=getattr(tokenizer, "eos_id", None),
+                                loss_scale=1.0 / self.grad_accum_steps)
         )
-        
+        self.device = torch.device(f"cuda:{os.environ['LOCAL_RANK']}")
+        self.copy_stream = torch.cuda.Stream(device=self.device)
+        self.pp_last_src = gpc.get_world_size(ParallelMode.PIPELINE) - 1
+        # the stage a rank runs never changes, so query the context once
+        self.is_last_stage = gpc.is_pipeline_last_stage()
+        # detokenization in compute_metrics is pure CPU work, so run it on a
+        # background thread instead of stalling the last stage between batches
+        self.metrics_executor = ThreadPoolExecutor(max_workers=1)
+
+    def _move_batch(self, batch):
+        # copy pinned host tensors on a side stream so the H2D transfer
+        # overlaps the compute of the previous micro-batch
+        inputs, labels = batch
+        with torch.cuda.stream(self.copy_stream):
+            inputs = {key: value.to(self.device, non_blocking=True)
+                      if torch.is_tensor(value) else value
+                      for key, value in inputs.items()}
+            labels = labels.to(self.device, non_blocking=True)
+        compute_stream = torch.cuda.current_stream(self.device)
+        compute_stream.wait_stream(self.copy_stream)
+        # the device copies were allocated on the side stream; tell the caching
+        # allocator the compute stream uses them too, or their blocks can be
+        # recycled for the next batch's copy while this one is still being read
+        for value in inputs.values():
+            if torch.is_tensor(value):
+                value.record_stream(compute_stream)
+        labels.record_stream(compute_stream)
+        # fold the labels into a dict-style batch: the schedule merges every
+        # entry into each stage's kwargs, so input_ids reaches the non-first
+        # stages too and their layers can rebuild the packed attention
+        # boundaries; a (data, label) tuple is only delivered to stage 0
+        inputs["label"] = labels
+        return inputs
+
     def train(self):
         self.engine.train()
+        def optimizer_step():
+            try:
+                self.engine.step()
+            except torch.cuda.OutOfMemoryError:
+                # emptying the cache every step defeats the caching
+                # allocator, so only fall back to it on a real OOM
+                torch.cuda.empty_cache()
+                self.engine.step()
+            self.engine.zero_grad()
         def train_loop(epoch: int = 0):
-            with tqdm.tqdm(self.train_dataloader, disable=not gpc.is_pipeline_last_stage()) as tqb:
+            batch_it = _Repeat()
+            grad_accum_steps = self.grad_accum_steps
+            step = 0
+            # generate() flips the engine to eval mode and a preceding
+            # epoch-boundary eval would otherwise leak that into this epoch
+            self.engine.train()
+            self.engine.zero_grad()
+            with tqdm.tqdm(self.train_dataloader, disable=not self.is_last_stage) as tqb:
                 for step, batch in enumerate(tqb, start=1):
-                    self.engine.zero_grad()
+                    batch_it.item = self._move_batch(batch)
                     _, _, loss = self.engine.execute_schedule(
-                        cycle([batch]),
+                        batch_it,
                         forward_only=False,
                         return_loss=True,
                         return_output_label=False,
                     )
-                    self.engine.step()
-                    torch.cuda.empty_cache()
-                    if gpc.is_pipeline_last_stage():
-                        tqb.set_postfix({'epoch': epoch, 'step': step, 'loss': loss.item()})
+                    if step % grad_accum_steps == 0:
+                        optimizer_step()
+                    if self.is_last_stage:
+                        # the criterion scales by 1/K, undo it for display
+                        tqb.set_postfix({'epoch': epoch, 'step': step,
+                                         'loss': loss.item() * grad_accum_steps})
                     if self.trainer_args.eval_per_steps == 0:
                         continue
                     elif self.trainer_args.eval_per_steps == -1:
                         self.eval(epoch, step)
+                        self.engine.train()
                     elif self.trainer_args.eval_per_steps > 0 and step % self.trainer_args.eval_per_steps == 0:
                         self.eval(epoch, step)
+                        self.engine.train()
+            if step % grad_accum_steps != 0:
+                # flush the partial trailing window so its gradients are not
+                # carried into the next epoch (or silently dropped)
+                optimizer_step()
         if self.trainer_args.epochs == 0:
             return
         elif self.trainer_args.epochs == -1:
@@ -123,49 +211,104 @@ class ColossalaiTrainer:
                  batch: Tuple[Dict[str, torch.Tensor], torch.Tensor],
                  max_length: int = 1024,
                  stop_tokens: List[int] = [2]):
-        with tqdm.tqdm(range(max_length), disable=not gpc.is_pipeline_last_stage()) as tqb:
-            past_key_value = torch.empty(batch[0]["input_ids"].shape[0], 0).to(torch.device(f"cuda:{os.environ['LOCAL_RANK']}")) # shape: (batch_size, 0)
+        self.engine.eval()
+        input_ids = batch[0]["input_ids"].to(self.device)
+        batch_size, prompt_len = input_ids.shape
+        if prompt_len >= max_length:
+            # nothing to decode within the budget, and the token buffer and
+            # KV cache below are sized to max_length, so bail out before
+            # allocating them rather than overrun the cache on step one
+            batch[0]["input_ids"] = input_ids[:, :max_length]
+            return batch
+        dtype = next(self.model.parameters()).dtype
+        for module in self.model.modules():
+            if hasattr(module, "init_kv_cache"):
+                module.init_kv_cache(batch_size, max_length, self.device, dtype)
+        # all generated tokens live in one pre-allocated buffer so the decode
+        # loop only does in-place column writes instead of re-allocating a
+        # growing tensor every step
+        ids = torch.zeros(batch_size, max_length, dtype=torch.int32, device=self.device)
+        ids[:, :prompt_len] = input_ids
+        end_pos = prompt_len
+        # dict-style micro-batches: the schedule merges every entry into the
+        # kwargs of EVERY stage (non-first stages get the previous stage's
+        # output as the positional hidden_states), so input_ids and cache_pos
+        # reach the whole pipeline; with the (data, label) tuple format only
+        # stage 0 ever saw them and the other stages skipped their KV caches
+        sched_inputs = {"input_ids": ids[:, :0], "cache_pos": None,
+                        "label": ids[:, :0]}
+        sched_it = _Repeat()
+        # int32 ids are plenty for a 32k vocab and halve the broadcast bytes
+        stop_tokens_t = torch.tensor(stop_tokens, dtype=torch.int32, device=self.device)
+        # one persistent buffer shared by argmax and broadcast, instead of a
+        # fresh allocation plus a same-device copy every step
+        next_buf = torch.zeros(batch_size, 1, dtype=torch.int32, device=self.device)
+        # the schedule slices every value in the data dict along dim 0, so the
+        # cache position travels as one entry per row rather than a plain int
+        cache_pos_buf = torch.zeros(batch_size, dtype=torch.int32, device=self.device)
+
+        def forward_step(step_ids, cache_pos):
+            cache_pos_buf.fill_(cache_pos)
+            sched_inputs["input_ids"] = step_ids
+            sched_inputs["cache_pos"] = cache_pos_buf
+            sched_inputs["label"] = step_ids
+            sched_it.item = sched_inputs
+            return self.engine.execute_schedule(
+                sched_it,
+                forward_only=True,
+                return_loss=False,
+                return_output_label=True,
+            )
+
+        # NOTE: the decode step cannot be captured as a CUDA graph here: every
+        # iteration goes through the colossalai pipeline schedule, whose
+        # stage-to-stage communication is orchestrated on the host, and the KV
+        # cache is indexed with a Python-int position that capture would bake
+        # into the kernels. The token broadcast is already issued async below.
+        with tqdm.tqdm(range(prompt_len, max_length), disable=not self.is_last_stage) as tqb:
+            # prefill: one pipeline traversal over the whole prompt primes the
+            # KV cache, after which every roundtrip carries a single token
+            hidden_states, label, _ = forward_step(ids[:, :prompt_len], 0)
             for current_pos in tqb:
-                try:
-                    self.engine.eval()
-                    hidden_states, label, _ = self.engine.execute_schedule(
-                        cycle([({
-                            # "input_ids": batch[0]["input_ids"][:, current_pos:current_pos+1],
-                            "input_ids": batch[0]["input_ids"],
-                            # "past_key_value": past_key_value
-                        }, batch[0]["input_ids"])]),
-                        forward_only=True,
-                        return_loss=False,
-                        return_output_label=True,
-                    )
-                    current_pos += 1
-                    next_tokens = torch.zeros(batch[0]["input_ids"].shape[0], 1, dtype=torch.long).to(torch.device(f"cuda:{os.environ['LOCAL_RANK']}"))
-                    if gpc.is_pipeline_last_stage():
-                        next_tokens = torch.argmax(hidden_states[:, -1, :], dim=-1)
-                        next_tokens = torch.unsqueeze(next_tokens, dim=-1)
-                    torch.distributed.broadcast(next_tokens, src=gpc.get_world_size(ParallelMode.PIPELINE) - 1)
-                    next_tokens = next_tokens.to(batch[0]["input_ids"].device)
-                    while current_pos >= batch[0]["input_ids"].shape[1]:
-                        batch[0]["input_ids"] = torch.cat([batch[0]["input_ids"], torch.zeros_like(next_tokens)], dim=1)
-                    batch[0]["input_ids"][:, current_pos] = torch.where(batch[0]["input_ids"][:, current_pos] == 0, next_tokens[:, 0], batch[0]["input_ids"][:, current_pos])
-                    tqb.set_postfix({'generating': f"{current_pos}/{max_length}"})
-                    for i in torch.flatten(next_tokens).tolist():
-                            if i in stop_tokens:
-                                raise StopIteration
-                    torch.cuda.empty_cache()
-                except StopIteration:
+                if current_pos > prompt_len:
+                    hidden_states, label, _ = forward_step(
+                        ids[:, current_pos - 1:current_pos], current_pos - 1)
+                if self.is_last_stage:
+                    next_buf.copy_(torch.argmax(
+                        hidden_states[:, -1, :], dim=-1, keepdim=True))
+                handle = torch.distributed.broadcast(
+                    next_buf, src=self.pp_last_src, async_op=True)
+                # host-side bookkeeping overlaps the in-flight broadcast
+                end_pos = current_pos + 1
+                tqb.set_postfix({'generating': f"{current_pos}/{max_length}"})
+                handle.wait()
+                # every column past the prompt is untouched until its step,
+                # so a plain write replaces the old read-compare-select
+                ids[:, current_pos] = next_buf[:, 0]
+                # one reduction + one .item() instead of a device->host copy
+                # and Python loop over the whole batch
+                if torch.isin(next_buf.view(-1), stop_tokens_t).any().item():
                     break
+        for module in self.model.modules():
+            if hasattr(module, "clear_kv_cache"):
+                module.clear_kv_cache()
+        batch[0]["input_ids"] = ids[:, :end_pos]
         return batch
     
     def eval(self, epoch, step):
-        with tqdm.tqdm(self.eval_dataloader, disable=not gpc.is_pipeline_last_stage()) as tqb:
+        total_eval = len(self.eval_dataloader)
+        metrics_jobs = []
+        with tqdm.tqdm(self.eval_dataloader, disable=not self.is_last_stage) as tqb:
             for eval_step, batch in enumerate(tqb, start=1):
                 with torch.no_grad():
                     generated_batch = self.generate(batch,
                                                     max_length=self.trainer_args.eval_max_length,
                                                     stop_tokens=self.trainer_args.eval_stop_tokens)
-                    if gpc.is_pipeline_last_stage() and self.compute_metrics is not None:
-                        self.compute_metrics(batch, generated_batch, epoch, step)
-                tqb.set_postfix({'evaluating': f"{eval_step}/{len(self.eval_dataloader)}"})
-            torch.cuda.empty_cache()
-            print(torch.cuda.memory_allocated())
\ No newline at end of file
+                    if self.is_last_stage and self.compute_metrics is not None:
+                        metrics_jobs.append(self.metrics_executor.submit(
+                            self.compute_metrics, batch, generated_batch, epoch, step))
+                tqb.set_postfix({'evaluating': f"{eval_step}/{total_eval}"})
+            # only block on the detokenization once all batches are generated
+            for job in metrics_jobs:
+                job.result()
+            torch.cuda.empty_cache()
\ No newline at end of file
@@ -1,6 +1,7 @@
 import sys
 
 import torch
+import torch.nn.functional as F
 import numpy as np
 
 try:
@@ -21,15 +22,38 @@ def inplace_grad(model, lr=5e-4):
     return func
 
 class GPTLMLoss(torch.nn.Module):
-    def __init__(self):
+    def __init__(self, eos_token_id=None, chunk_size=8192, loss_scale=1.0):
         super().__init__()
-        self.loss = torch.nn.CrossEntropyLoss()
+        self.eos_token_id = eos_token_id
+        self.chunk_size = chunk_size
+        # with gradient accumulation the trainer passes 1/K so the summed
+        # gradients of K windows average instead of growing K times larger
+        self.loss_scale = loss_scale
 
     def forward(self, logits, labels):
-        shift_logits = logits[..., :-1, :].contiguous()
-        shift_labels = labels[..., 1:].contiguous()
-        # Flatten the tokens
-        return self.loss(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
+        shift_logits = logits[..., :-1, :].contiguous().view(-1, logits.size(-1))
+        # collators ship int32 ids to save bandwidth; the loss needs int64
+        shift_labels = labels[..., 1:].contiguous().view(-1).long()
+        if self.eos_token_id is not None:
+            # with packed sequences the position whose input is EOS predicts
+            # the first token of the next document, so drop that label; the
+            # EOS targets themselves stay so documents still learn to end
+            shift_inputs = labels[..., :-1].contiguous().view(-1)
+            shift_labels = shift_labels.masked_fill(
+                shift_inputs == self.eos_token_id, -100)
+        # walk the flattened tokens in chunks so the vocab-wide softmax is
+        # never materialized for the whole batch at once; each chunk runs on
+        # upcast logits because even one chunk's fp16 sum can hit 65504
+        loss = shift_logits.new_zeros((), dtype=torch.float32)
+        count = shift_labels.new_zeros(())
+        for start in range(0, shift_labels.numel(), self.chunk_size):
+            chunk_logits = shift_logits[start:start + self.chunk_size]
+            chunk_labels = shift_labels[start:start + self.chunk_size]
+            loss = loss + F.cross_entropy(
+                chunk_logits.float(), chunk_labels, ignore_index=-100,
+                reduction="sum")
+            count = count + (chunk_labels != -100).sum()
+        return loss / count.clamp(min=1) * self.loss_scale
     
 def sample_top_p(probs, p):
     probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)